@@ -108,7 +108,7 @@ class Dug:
         if func is None:
             raise ValueError(f"Target must be one of {', '.join(targets.keys())}")
         results = event_loop.run_until_complete(func(query=query, **kwargs))
-        event_loop.run_until_complete(self._search.es.close())
+        event_loop.run_until_complete(self._search.close())
         return results
 
     def status(self):
@@ -1,13 +1,97 @@
 """Implements search methods using async interfaces"""
+import asyncio
 import logging
+from collections import defaultdict
+from contextlib import aclosing
+from functools import lru_cache
 from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import SerializationError
 from elasticsearch.helpers import async_scan
+from elasticsearch.serializer import JSONSerializer
+import orjson
 import ssl
+import time
 
 from dug.config import Config
 
 logger = logging.getLogger('dug')
 
+# Scroll settings for full-index scans: hits fetched per shard per round
+# trip, how long ES keeps each scroll context alive between batches, and
+# the timeout for each scroll request (seconds)
+_SCAN_BATCH = 5000
+_SCAN_SCROLL = '5m'
+_SCAN_TIMEOUT = 60
+
+# Number of distinct queries whose ES bodies are memoized per builder
+_QUERY_CACHE_SIZE = 1024
+
+# Seconds for which agg_data_type reuses its last result
+_AGG_CACHE_TTL = 60
+
+# Ranking clauses for the concept and variable searches, one row per
+# ``should`` clause: (field, query type, boost, extra parameters). "match"
+# clauses also get the request's fuzziness and prefix_length.
+_CONCEPT_CLAUSES = (
+    ("name", "match_phrase", 10, {}),
+    ("description", "match_phrase", 6, {}),
+    ("search_terms", "match_phrase", 8, {}),
+    ("name", "match", 4, {"operator": "and"}),
+    ("search_terms", "match", 5, {"operator": "and"}),
+    ("description", "match", 3, {"operator": "and"}),
+    ("description", "match", 2, {}),
+    ("search_terms", "match", 1, {}),
+    ("optional_terms", "match", None, {}),
+)
+
+# Counts of concept hits per biolink type, returned as concept_types
+_CONCEPT_TYPE_AGGS = {'type-count': {'terms': {'field': 'type'}}}
+
+# Concepts must have a non-empty name and description. This is a wildcard
+# "?*" rather than an exists query because concepts are indexed with ""
+# descriptions, which exists would match. This never changes, so the same
+# object is shared by every concepts query; treat it as read-only.
+_CONCEPT_FILTER = {
+    "bool": {
+        "must": [
+            {"wildcard": {"description": "?*"}},
+            {"wildcard": {"name": "?*"}}
+        ]
+    }
+}
+
+_VAR_CLAUSES = (
+    ("element_name", "match_phrase", 10, {}),
+    ("element_desc", "match_phrase", 6, {}),
+    ("search_terms", "match_phrase", 8, {}),
+    ("element_name", "match", 4, {"operator": "and"}),
+    ("search_terms", "match", 5, {"operator": "and"}),
+    ("element_desc", "match", 3, {"operator": "and"}),
+    ("element_desc", "match", 2, {}),
+    ("element_name", "match", 2, {}),
+    ("search_terms", "match", 1, {}),
+    ("optional_terms", "match", None, {}),
+)
+
+
+# Characters that switch search_concepts over to a simple_query_string search
+_SIMPLE_QUERY_CHARS = frozenset('*"+-')
+
+
+def _build_should(clauses, query, fuzziness, prefix_length):
+    "Materialize a clause table into a list of ES ``should`` clauses"
+    should = []
+    for field, kind, boost, extra in clauses:
+        params = {"query": query}
+        if kind == "match":
+            params["fuzziness"] = fuzziness
+            params["prefix_length"] = prefix_length
+        params.update(extra)
+        if boost is not None:
+            params["boost"] = boost
+        should.append({kind: {field: params}})
+    return should
+
 
 class SearchException(Exception):
     def __init__(self, message, details):
@@ -15,6 +99,33 @@ class SearchException(Exception):
         self.details = details
 
 
+class OrjsonSerializer(JSONSerializer):
+    "Elasticsearch JSON serializer backed by orjson"
+
+    def dumps(self, data):
+        # Pre-encoded bodies are passed through as-is
+        if isinstance(data, str):
+            return data.encode("utf-8", "surrogatepass")
+        if isinstance(data, bytes):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default,
+                                option=orjson.OPT_NON_STR_KEYS)
+        except TypeError as e:
+            raise SerializationError(
+                message=f"Unable to serialize to JSON: {data!r}", errors=(e,))
+
+    def loads(self, data):
+        # Some responses are typed as JSON but have an empty body
+        if data == b"":
+            return None
+        try:
+            return orjson.loads(data)
+        except ValueError as e:
+            raise SerializationError(
+                message=f"Unable to deserialize as JSON: {data!r}", errors=(e,))
+
+
 class Search:
     """ Search -
     1. Lexical fuzziness; (a) misspellings - a function of elastic.
@@ -26,6 +137,9 @@ class Search:
          * disease->phenotype->study
     """
 
+    # AsyncElasticsearch clients, keyed by connection settings
+    _clients = {}
+
     def __init__(self, cfg: Config, indices=None):
 
         if indices is None:
@@ -37,48 +151,103 @@ class Search:
                      f"{self._cfg.elastic_port}")
 
         self.indices = indices
-        self.hosts = [{'host': self._cfg.elastic_host,
-                       'port': self._cfg.elastic_port,
-                       'scheme': self._cfg.elastic_scheme}]
+        self.hosts = self._get_hosts(self._cfg)
 
+        self.es = self.get_client(self._cfg)
+        # (data type list, time.monotonic() when it was fetched)
+        self._agg_cache = (None, 0.0)
+
+    @staticmethod
+    def _get_hosts(cfg: Config):
+        "Elasticsearch host list for a config"
+        return [{'host': cfg.elastic_host,
+                 'port': cfg.elastic_port,
+                 'scheme': cfg.elastic_scheme}]
+
+    @classmethod
+    def get_client(cls, cfg: Config) -> AsyncElasticsearch:
+        """Return the AsyncElasticsearch client shared by every Search
+        pointing at the same cluster with the same credentials, creating
+        it on first use so connections are pooled across instances."""
+        key = (cfg.elastic_host, cfg.elastic_port, cfg.elastic_scheme,
+               cfg.elastic_username, cfg.elastic_password,
+               cfg.elastic_ca_path)
+        if key in cls._clients:
+            return cls._clients[key]
+
+        hosts = cls._get_hosts(cfg)
         logger.debug(f"Authenticating as user "
-                     f"{self._cfg.elastic_username} "
-                     f"to host:{self.hosts}")
-        if self._cfg.elastic_scheme == "https":
+                     f"{cfg.elastic_username} "
+                     f"to host:{hosts}")
+        if cfg.elastic_scheme == "https":
             ssl_context = ssl.create_default_context(
-                cafile=self._cfg.elastic_ca_path
+                cafile=cfg.elastic_ca_path
             )
-            self.es = AsyncElasticsearch(hosts=self.hosts,
-                                     basic_auth=(self._cfg.elastic_username,
-                                                self._cfg.elastic_password),
-                                                ssl_context=ssl_context)
+            client = AsyncElasticsearch(hosts=hosts,
+                                        basic_auth=(cfg.elastic_username,
+                                                    cfg.elastic_password),
+                                        ssl_context=ssl_context,
+                                        serializer=OrjsonSerializer())
         else:
-            self.es = AsyncElasticsearch(hosts=self.hosts,
-                                     basic_auth=(self._cfg.elastic_username,
-                                                self._cfg.elastic_password))
+            client = AsyncElasticsearch(hosts=hosts,
+                                        basic_auth=(cfg.elastic_username,
+                                                    cfg.elastic_password),
+                                        serializer=OrjsonSerializer())
+        cls._clients[key] = client
+        return client
+
+    async def close(self):
+        """Close the shared client. Meant to be called once, when the
+        application shuts down."""
+        for key, client in list(self._clients.items()):
+            if client is self.es:
+                del self._clients[key]
+        await self.es.close()
 
     async def dump_concepts(self, index, query={}, size=None,
-                            fuzziness=1, prefix_length=3):
+                            fuzziness=1, prefix_length=3, slices=1):
         """
         Get everything from concept index
+
+        The index is read with a sliced scroll, one ``async_scan`` per slice,
+        so that large dumps are spread over the shards instead of being
+        serialized through a single scroll cursor. Slicing only helps up to
+        the index's primary shard count, so ``slices`` defaults to 1 (the
+        Dug indices are created with a single shard).
         """
         query = {
             "match_all": {}
         }
         body = {"query": query}
-        await self.es.ping()
         total_items = await self.es.count(body=body, index=index)
-        counter = 0
+
         all_docs = []
-        async for doc in async_scan(
-                client=self.es,
-                query=body,
-                index=index
-        ):
-            if counter == size and size != 0:
-                break
-            counter += 1
-            all_docs.append(doc)
+        done = asyncio.Event()
+
+        async def worker(slice_id):
+            slice_body = dict(body)
+            if slices > 1:
+                # ES rejects a slice with max=1, so only slice when needed
+                slice_body["slice"] = {"id": slice_id, "max": slices}
+            # aclosing() clears the scroll context when we stop early
+            async with aclosing(self._scan(slice_body, index, size)) as docs:
+                async for doc in docs:
+                    if done.is_set():
+                        break
+                    all_docs.append(doc)
+                    if size and len(all_docs) >= size:
+                        done.set()
+                        break
+
+        workers = [asyncio.create_task(worker(i)) for i in range(slices)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # Don't leave the other slices scrolling if one of them fails
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
         return {
             "status": "success",
             "result": {
@@ -90,7 +259,27 @@ class Search:
             "message": "Search result"
         }
 
+    def _scan(self, query, index, limit=None):
+        """async_scan over an index, unordered and in large batches. If only
+        limit hits are wanted, batches are no bigger than that."""
+        batch = min(_SCAN_BATCH, limit) if limit else _SCAN_BATCH
+        return async_scan(
+            client=self.es,
+            query=query,
+            index=index,
+            size=batch,
+            scroll=_SCAN_SCROLL,
+            preserve_order=False,
+            raise_on_error=True,
+            request_timeout=_SCAN_TIMEOUT
+        )
+
     async def agg_data_type(self):
+        data_type_list, fetched = self._agg_cache
+        if (data_type_list is not None
+                and time.monotonic() - fetched < _AGG_CACHE_TTL):
+            return data_type_list
+
         aggs = {
             "data_type": {
                 "terms": {
@@ -100,164 +289,81 @@ class Search:
         }
 
         body = {'aggs': aggs}
+        # Only size=0 requests are eligible for the shard request cache
         results = await self.es.search(
             index="variables_index",
-            body=body
+            body=body,
+            size=0,
+            request_cache=True
         )
         data_type_list = [data_type['key'] for data_type in
                           results['aggregations']['data_type']['buckets']]
-        results.update({'data type list': data_type_list})
+        self._agg_cache = (data_type_list, time.monotonic())
         return data_type_list
 
     @staticmethod
+    @lru_cache(maxsize=_QUERY_CACHE_SIZE)
     def _get_concepts_query(query, fuzziness=1, prefix_length=3):
-        "Static data structure populator, pulled for easier testing"
+        """Static data structure populator, pulled for easier testing.
+        Results are memoized and shared between calls, so callers must
+        copy before modifying them."""
         query_object = {
             "query" : {
                 "bool": {
-                    "filter": {
-                        "bool": {
-                            "must": [
-                                {"wildcard": {"description": "?*"}},
-                                {"wildcard": {"name": "?*"}}
-                            ]
-                        }
-                    },
-                    "should": [
-                        {
-                            "match_phrase": {
-                                "name": {
-                                    "query": query,
-                                    "boost": 10
-                                }
-                            }
-                        },
-                        {
-                            "match_phrase": {
-                                "description": {
-                                    "query": query,
-                                    "boost": 6
-                                }
-                            }
-                        },
-                        {
-                            "match_phrase": {
-                                "search_terms": {
-                                    "query": query,
-                                    "boost": 8
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "name": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "operator": "and",
-                                    "boost": 4
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "search_terms": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "operator": "and",
-                                    "boost": 5
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "description": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "operator": "and",
-                                    "boost": 3
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "description": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "boost": 2
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "search_terms": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "boost": 1
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "optional_terms": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length
-                                }
-                            }
-                        }
-                    ],
+                    "filter": _CONCEPT_FILTER,
+                    "should": _build_should(_CONCEPT_CLAUSES, query,
+                                            fuzziness, prefix_length),
                     "minimum_should_match": 1,
                 }
             }
         }
         return query_object
 
+    @staticmethod
+    @lru_cache(maxsize=_QUERY_CACHE_SIZE)
+    def _get_concepts_body(query, types=None, fuzziness=1, prefix_length=3):
+        """Full search_concepts request body. It does not depend on offset
+        or size, so paging through results reuses the same body. Results are
+        memoized and shared between calls; callers must not modify them."""
+        if not _SIMPLE_QUERY_CHARS.isdisjoint(query):
+            search_body = Search.get_simple_search_query(query)
+        else:
+            search_body = dict(Search._get_concepts_query(
+                query, fuzziness, prefix_length))
+        # Get aggregated counts of biolink types
+        search_body['aggs'] = _CONCEPT_TYPE_AGGS
+        if types is not None:
+            search_body['post_filter'] = {"terms": {"type": list(types)}}
+        return search_body
+
     async def search_concepts(self, query, offset=0, size=None, types=None,
-                              **kwargs):
+                              explain=False, **kwargs):
         """
         Changed to a long boolean match query to optimize search results
+
+        Scoring explanations (hits.hits._explanation) are only computed and
+        returned when explain is True.
         """
-        if "*" in query or "\"" in query or "+" in query or "-" in query:
-            search_body = self.get_simple_search_query(query)
-        else:
-            search_body = self._get_concepts_query(query, **kwargs)
-        # Get aggregated counts of biolink types
-        search_body['aggs'] = {'type-count': {'terms': {'field': 'type'}}}
-        if isinstance(types, list):
-            search_body['post_filter'] = {
-                "bool": {
-                    "should": [
-                        {'term': {'type': {'value': t}}} for t in types
-                    ],
-                    "minimum_should_match": 1
-                }
-            }
+        # Only a list of types filters the search, as before; the cache
+        # needs it as a tuple
+        types = tuple(types) if isinstance(types, list) else None
+        search_body = self._get_concepts_body(query, types, **kwargs)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Concepts body cache: %s",
+                         self._get_concepts_body.cache_info())
+        filter_path = ['hits.total', 'hits.hits._id', 'hits.hits._type',
+                       'hits.hits._source', 'hits.hits._score',
+                       'aggregations']
+        if explain:
+            filter_path.append('hits.hits._explanation')
         search_results = await self.es.search(
             index="concepts_index",
             body=search_body,
-            filter_path=['hits.hits._id', 'hits.hits._type',
-                         'hits.hits._source', 'hits.hits._score',
-                         'hits.hits._explanation', 'aggregations'],
+            filter_path=filter_path,
             from_=offset,
             size=size,
-            explain=True
-        )
-        # Aggs/post_filter aren't supported by count
-        del search_body["aggs"]
-        if "post_filter" in search_body:
-            # We'll move the post_filter into the actual filter
-            search_body["query"]["bool"]["filter"]["bool"].update(
-                search_body["post_filter"]["bool"]
-            )
-            del search_body["post_filter"]
-        total_items = await self.es.count(
-            body=search_body,
-            index="concepts_index"
+            explain=explain,
+            track_total_hits=True
         )
 
         # Simplify the data structure we get from aggregations to put into the
@@ -268,10 +374,26 @@ class Search:
             bucket['key']: bucket['doc_count'] for bucket in
             aggregations['type-count']['buckets']
         }
-        search_results.update({'total_items': total_items['count']})
+        search_results.update({'total_items': self._pop_total(search_results)})
         search_results.update({'concept_types': concept_types})
         return search_results
 
+    async def multi_search(self, specs):
+        """
+        Run several searches in a single _msearch round trip.
+
+        specs is a list of {"index": ..., "body": ...} dicts, where body is
+        a regular search body (query, aggs, from, size, ...). Returns the
+        responses in the same order; a search that failed has an "error"
+        entry instead of hits.
+        """
+        searches = []
+        for spec in specs:
+            searches.append({"index": spec["index"]})
+            searches.append(spec["body"])
+        results = await self.es.msearch(searches=searches)
+        return results["responses"]
+
     async def search_variables(self, concept="", query="", size=None,
                                data_type=None, offset=0, fuzziness=1,
                                prefix_length=3, index=None):
@@ -287,23 +409,28 @@ class Search:
         the passed-in data type.
         """
         es_query = self._get_var_query(concept, fuzziness, prefix_length, query)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Variables query cache: %s",
+                         self._get_var_query.cache_info())
+        es_query = self._filter_data_type(es_query, data_type)
         if index is None:
             index = "variables_index"
 
-        total_items = await self.es.count(body=es_query, index=index)
         search_results = await self.es.search(
-            index="variables_index",
+            index=index,
             body=es_query,
-            filter_path=['hits.hits._id', 'hits.hits._type',
+            filter_path=['hits.total', 'hits.hits._id', 'hits.hits._type',
                          'hits.hits._source', 'hits.hits._score'],
             from_=offset,
-            size=size
+            size=size,
+            track_total_hits=True
         )
+        total_items = self._pop_total(search_results)
 
         search_result_hits = []
 
         if "hits" in search_results:
-            search_result_hits = search_results['hits']['hits']
+            search_result_hits = search_results['hits'].get('hits', [])
 
         return self._make_result(data_type, search_result_hits , total_items, True)
 
@@ -323,67 +450,97 @@ class Search:
         the passed-in data type.
         """
         es_query = self._get_var_query(concept, fuzziness, prefix_length, query)
+        es_query = self._filter_data_type(es_query, data_type)
         total_items = await self.es.count(body=es_query, index="variables_index")
-        search_results = []
-        async for r in async_scan(self.es, query=es_query):
-            search_results.append(r)
+        # Merge hits as they arrive rather than holding the whole scan
+        new_results = defaultdict(dict)
+        async with aclosing(self._scan(es_query, "variables_index")) as hits:
+            async for r in hits:
+                self._merge_hit(new_results, r, False)
+
+        return self._finish_result(new_results, data_type,
+                                   total_items['count'])
+
+    @staticmethod
+    def _filter_data_type(es_query, data_type):
+        """Restrict a variables query to one data type, so ES only returns
+        the hits _make_result would keep. Returns a new body and leaves the
+        (cached) es_query untouched."""
+        if not data_type:
+            return es_query
+        bool_query = dict(es_query["query"]["bool"])
+        bool_query["filter"] = bool_query.get("filter", []) + [
+            {"term": {"data_type.keyword": data_type}}
+        ]
+        return {**es_query, "query": {"bool": bool_query}}
 
-        return self._make_result(data_type, search_results, total_items, False)
+    @staticmethod
+    def _pop_total(search_results):
+        """Remove hits.total from a search response and return its value.
+        hits.total is only requested (track_total_hits) to avoid a separate
+        count call, so it is not passed on to callers."""
+        hits = search_results.get('hits', {})
+        total = hits.pop('total', {}).get('value', 0)
+        if not hits:
+            search_results.pop('hits', None)
+        return total
 
     def _make_result(self, data_type, search_results, total_items, scored: bool):
         # Reformat Results
-        new_results = {}
-        if not search_results:
-            # we don't want to error on a search not found
-            new_results.update({'total_items': total_items['count']})
-            return new_results
+        new_results = defaultdict(dict)
         for elem in search_results:
-            elem_s = elem['_source']
-            elem_type = elem_s['data_type']
-            if elem_type not in new_results:
-                new_results[elem_type] = {}
-
-            elem_id = elem_s['element_id']
-            coll_id = elem_s['collection_id']
-            elem_info = {
-                "description": elem_s['element_desc'],
-                "e_link": elem_s['element_action'],
-                "id": elem_id,
-                "name": elem_s['element_name']
+            self._merge_hit(new_results, elem, scored)
+        return self._finish_result(new_results, data_type, total_items)
+
+    @staticmethod
+    def _merge_hit(new_results, elem, scored: bool):
+        """Add one variables_index hit to new_results, a
+        defaultdict(dict) of {data_type: {collection_id: doc}}"""
+        elem_s = elem['_source']
+        collections = new_results[elem_s['data_type']]
+        coll_id = elem_s['collection_id']
+        elem_info = {
+            "description": elem_s['element_desc'],
+            "e_link": elem_s['element_action'],
+            "id": elem_s['element_id'],
+            "name": elem_s['element_name']
+        }
+
+        if scored:
+            elem_info["score"] = round(elem['_score'], 6)
+
+        doc = collections.get(coll_id)
+        # Case: collection not in dictionary for given data_type
+        if doc is None:
+            # initialize and save document
+            collections[coll_id] = {
+                'c_id': coll_id,
+                'c_link': elem_s['collection_action'],
+                'c_name': elem_s['collection_name'],
+                'elements': [elem_info]
             }
 
-            if scored:
-                elem_info["score"]: round(elem['_score'], 6)
-
-            # Case: collection not in dictionary for given data_type
-            if coll_id not in new_results[elem_type]:
-                # initialize document
-                doc = {
-                    'c_id': coll_id,
-                    'c_link': elem_s['collection_action'],
-                    'c_name': elem_s['collection_name'],
-                    'elements': [elem_info]
-                }
-                # save document
-                new_results[elem_type][coll_id] = doc
+        # Case: collection already in dictionary for given
+        # element_type; append elem_info.  Assumes no duplicate
+        # elements
+        else:
+            doc['elements'].append(elem_info)
 
-            # Case: collection already in dictionary for given
-            # element_type; append elem_info.  Assumes no duplicate
-            # elements
-            else:
-                new_results[elem_type][coll_id]['elements'].append(elem_info)
+    @staticmethod
+    def _finish_result(new_results, data_type, total_items):
+        "Flatten merged hits into the search_variables result format"
         # Flatten dicts to list
-        for i in new_results:
-            new_results[i] = list(new_results[i].values())
+        results = {elem_type: list(collections.values())
+                   for elem_type, collections in new_results.items()}
         # Return results
         if bool(data_type):
-            if data_type in new_results:
-                new_results = new_results[data_type]
+            if data_type in results:
+                results = {data_type: results[data_type]}
             else:
-                new_results = {}
+                results = {}
 
-        new_results.update({'total_items': total_items['count']})
-        return new_results
+        results.update({'total_items': total_items})
+        return results
 
     async def search_kg(self, unique_id, query, offset=0, size=None,
                         fuzziness=1, prefix_length=3):
@@ -410,16 +567,16 @@ class Search:
             }
         }
         body = {'query': query}
-        total_items = await self.es.count(body=body, index="kg_index")
         search_results = await self.es.search(
             index="kg_index",
             body=body,
-            filter_path=['hits.hits._id', 'hits.hits._type',
+            filter_path=['hits.total', 'hits.hits._id', 'hits.hits._type',
                          'hits.hits._source'],
             from_=offset,
-            size=size
+            size=size,
+            track_total_hits=True
         )
-        search_results.update({'total_items': total_items['count']})
+        search_results.update({'total_items': self._pop_total(search_results)})
         return search_results
 
     async def search_study(self, study_id=None, study_name=None, offset=0, size=None):
@@ -427,42 +584,51 @@ class Search:
         Search for studies by unique_id (ID or name) and/or study_name.
         """
         # Define the base query
-         # Define the base query
         query_body = {
             "bool": {
-                "must": []
+                "must": [],
+                "filter": []
             }
         }
-        
+
         # Add conditions based on user input
         if study_id:
-            query_body["bool"]["must"].append({
-                "match": {"collection_id": study_id}
+            # Exact ID lookup on the keyword subfield: no analysis or
+            # scoring, and ES can cache the filter
+            query_body["bool"]["filter"].append({
+                "term": {"collection_id.keyword": study_id}
             })
-        
+
         if study_name:
+            # Scored, so the best name matches come first
             query_body["bool"]["must"].append({
                 "match": {"collection_name": study_name}
             })
 
-        print("query_body",query_body)
+        logger.debug("query_body %s", query_body)
         body = {'query': query_body}
-        total_items = await self.es.count(body=body, index="variables_index")
         search_results = await self.es.search(
             index="variables_index",
             body=body,
-            filter_path=['hits.hits._id', 'hits.hits._type', 'hits.hits._source'],
+            filter_path=['hits.total', 'hits.hits._id', 'hits.hits._type', 'hits.hits._source'],
             from_=offset,
-            size=size
+            size=size,
+            track_total_hits=True
         )
-        search_results.update({'total_items': total_items['count']})
+        search_results.update({'total_items': self._pop_total(search_results)})
         return search_results
 
-    async def search_program(self, program_name=None, offset=0, size=None):
+    async def search_program(self, program_name=None, offset=0, size=None,
+                             include_hits=True):
         """
         Search for studies by unique_id (ID or name) and/or study_name.
+
+        The studies are returned as the unique_collection_ids aggregation,
+        along with matching variables as hits, which carry collection_name
+        and collection_action. Pass include_hits=False to get only the
+        aggregation, without fetching or scoring any hits.
         """
-    
+
         query_body = {
             "query": {
                 "bool": {
@@ -478,142 +644,45 @@ class Search:
             }
         }
 
-        # specify the fields to be returned
-        query_body["_source"] = ["collection_id", "collection_name", "collection_action"]
-
         # search for program_name based on uses input
         if program_name:
             query_body["query"]["bool"]["must"].append({
                 "match": {"data_type": program_name}
             })
 
-        print("query_body", query_body)
+        filter_path = ['aggregations.unique_collection_ids.buckets']
+        if include_hits:
+            # specify the fields to be returned
+            query_body["_source"] = ["collection_id", "collection_name", "collection_action"]
+            filter_path += ['hits.hits._id', 'hits.hits._type', 'hits.hits._source']
+        else:
+            # Only the aggregation is needed, so skip fetching and scoring hits
+            offset, size = None, 0
 
-        # Prepare the query body for execution
-        body = query_body
-        #print(body)
+        logger.debug("query_body %s", query_body)
 
-        # Execute the search query
+        # Execute the search query. The unique collection_ids will be in the
+        # 'aggregations' field of the response
         search_results = await self.es.search(
             index="variables_index",
-            body=body,
-            filter_path=['hits.hits._id', 'hits.hits._type', 'hits.hits._source', 'aggregations.unique_collection_ids.buckets'],
+            body=query_body,
+            filter_path=filter_path,
             from_=offset,
-            size=size
+            size=size,
+            track_total_hits=False
         )
-
-        # The unique collection_ids will be in the 'aggregations' field of the response
-        unique_collection_ids = search_results['aggregations']['unique_collection_ids']['buckets']
-
-        #print("Unique collection_ids:", unique_collection_ids)
-
-
-        #print(search_results)
         return search_results
 
-    def _get_var_query(self, concept, fuzziness, prefix_length, query):
-        """Returns ES query for variable search"""
+    @staticmethod
+    @lru_cache(maxsize=_QUERY_CACHE_SIZE)
+    def _get_var_query(concept, fuzziness, prefix_length, query):
+        """Returns ES query for variable search. Results are memoized and
+        shared between calls, so callers must copy before modifying them."""
         es_query = {
             "query": {
                 'bool': {
-                    'should': [
-                        {
-                            "match_phrase": {
-                                "element_name": {
-                                    "query": query,
-                                    "boost": 10
-                                }
-                            }
-                        },
-                        {
-                            "match_phrase": {
-                                "element_desc": {
-                                    "query": query,
-                                    "boost": 6
-                                }
-                            }
-                        },
-                        {
-                            "match_phrase": {
-                                "search_terms": {
-                                    "query": query,
-                                    "boost": 8
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "element_name": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "operator": "and",
-                                    "boost": 4
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "search_terms": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "operator": "and",
-                                    "boost": 5
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "element_desc": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "operator": "and",
-                                    "boost": 3
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "element_desc": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "boost": 2
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "element_name": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "boost": 2
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "search_terms": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length,
-                                    "boost": 1
-                                }
-                            }
-                        },
-                        {
-                            "match": {
-                                "optional_terms": {
-                                    "query": query,
-                                    "fuzziness": fuzziness,
-                                    "prefix_length": prefix_length
-                                }
-                            }
-                        }
-                    ]
+                    'should': _build_should(_VAR_CLAUSES, query,
+                                            fuzziness, prefix_length)
                 }
             }
         }
@@ -625,7 +694,8 @@ class Search:
             }
         return es_query
 
-    def get_simple_search_query(self, query):
+    @staticmethod
+    def get_simple_search_query(query):
         """Returns ES query that allows to use basic operators like AND, OR, NOT...
         More info here https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-simple-query-string-query.html."""
         search_query = {
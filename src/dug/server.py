@@ -7,7 +7,6 @@ from fastapi.middleware.cors import CORSMiddleware
 from dug.config import Config
 from dug.core.async_search import Search
 from pydantic import BaseModel
-import asyncio
 from typing import Optional
 
 logger = logging.getLogger (__name__)
@@ -36,6 +35,8 @@ class SearchConceptQuery(BaseModel):
     offset: int = 0
     size: int = 20
     types: list = None
+    # Debugging aid: include Elasticsearch's scoring explanation of each hit
+    explain: bool = False
 
 class SearchVariablesQuery(BaseModel):
     query: str
@@ -65,9 +66,17 @@ class SearchProgramQuery(BaseModel):
 
 search = Search(Config.from_env())
 
+@APP.on_event("startup")
+async def startup_event():
+    # One-time connectivity check; searches surface connection errors
+    # themselves, so an unreachable cluster is only reported here
+    if not await search.es.ping():
+        logger.error(f"Unable to connect to elasticsearch at {search.hosts}")
+
+
 @APP.on_event("shutdown")
-def shutdown_event():
-    asyncio.run(search.es.close())
+async def shutdown_event():
+    await search.close()
 
 
 @APP.post('/dump_concepts')
@@ -136,11 +145,13 @@ async def search_study(study_id: Optional[str] = None, study_name: Optional[str]
 
 
 @APP.get('/search_program')
-async def search_program( program_name: Optional[str] = None):
+async def search_program( program_name: Optional[str] = None, include_hits: bool = True):
     """
     Search for studies by unique_id (ID or name) and/or study_name.
+    Pass include_hits=false to get only the unique_collection_ids buckets.
     """
-    result = await search.search_program(program_name=program_name)
+    result = await search.search_program(program_name=program_name,
+                                         include_hits=include_hits)
     return {
         "message": "Search result",
         "result": result,
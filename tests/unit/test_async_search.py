@@ -42,9 +42,230 @@ class SearchTestCase(TestCase):
         self.assertEqual(len(result['concept_types']), 9)
         self.assertEqual(result['concept_types']['anatomical entity'], 10)
 
+    def test_concepts_search_explain(self):
+        "Test that scoring explanations are only requested on demand"
+        es = mock.AsyncMock()
+        es.search.return_value = _brain_search_result()
+        self.search.es = es
+        asyncio.run(self.search.search_concepts("brain", types=['drug']))
+        kwargs = es.search.call_args.kwargs
+        self.assertEqual(kwargs['body']['post_filter'],
+                         {'terms': {'type': ['drug']}})
+        self.assertFalse(kwargs['explain'])
+        self.assertNotIn('hits.hits._explanation', kwargs['filter_path'])
+
+        es.search.return_value = _brain_search_result()
+        asyncio.run(self.search.search_concepts("brain", explain=True))
+        kwargs = es.search.call_args.kwargs
+        self.assertTrue(kwargs['explain'])
+        self.assertIn('hits.hits._explanation', kwargs['filter_path'])
+
+    def test_concepts_search_types_not_list(self):
+        "Test that types only filters concepts when it is a list"
+        es = mock.AsyncMock()
+        es.search.return_value = _brain_search_result()
+        self.search.es = es
+        asyncio.run(self.search.search_concepts("brain", types="drug"))
+        self.assertNotIn('post_filter', es.search.call_args.kwargs['body'])
+
+    def test_concepts_query_cached(self):
+        "Test that cached concept queries are not modified by searches"
+        asyncio.run(self.search.search_concepts(
+            "brain", types=['anatomical entity']))
+        self.assertIs(self.search._get_concepts_query("brain"),
+                      self.query_body)
+        self.assertEqual(set(self.query_body), {'query'})
+
+    def test_concepts_body_reused_across_pages(self):
+        "Test that paging through concepts reuses one request body"
+        es = mock.AsyncMock()
+        es.search.side_effect = lambda **kwargs: _brain_search_result()
+        self.search.es = es
+        for offset in (0, 20, 40):
+            asyncio.run(self.search.search_concepts(
+                "brain", offset=offset, size=20, types=['drug']))
+        bodies = [call.kwargs['body'] for call in es.search.call_args_list]
+        self.assertIs(bodies[0], bodies[1])
+        self.assertIs(bodies[0], bodies[2])
+        self.assertEqual([call.kwargs['from_'] for call in
+                          es.search.call_args_list], [0, 20, 40])
+
+    def test_multi_search(self):
+        "Test that several searches are sent as one msearch request"
+        es = mock.AsyncMock()
+        es.msearch.return_value = {'responses': [_brain_search_result(),
+                                                 {'hits': {'hits': []}}]}
+        self.search.es = es
+        var_query = self.search._get_var_query("", 1, 3, "brain")
+        responses = asyncio.run(self.search.multi_search([
+            {"index": "concepts_index", "body": self.query_body},
+            {"index": "variables_index", "body": var_query},
+        ]))
+        self.assertEqual(len(responses), 2)
+        es.msearch.assert_awaited_once_with(searches=[
+            {"index": "concepts_index"}, self.query_body,
+            {"index": "variables_index"}, var_query])
+
+    def test_dump_concepts_slice_failure(self):
+        "Test that a failing slice cancels the remaining ones"
+        closed = []
+
+        async def _mock_scan(client, query, index, **kwargs):
+            try:
+                if query['slice']['id'] == 0:
+                    raise ValueError("slice failed")
+                await asyncio.sleep(10)
+                yield {'_id': 'never'}
+            finally:
+                closed.append(query['slice']['id'])
+
+        with mock.patch.object(async_search, 'async_scan', _mock_scan):
+            with self.assertRaises(ValueError):
+                asyncio.run(self.search.dump_concepts(
+                    'concepts_index', slices=3))
+        self.assertEqual(sorted(closed), [0, 1, 2])
+
+    def test_make_result_data_type(self):
+        "Test that variable hits are grouped and filtered by data type"
+        hits = [_variable_hit('phs000001', 'phv1', 'dbGaP'),
+                _variable_hit('phs000001', 'phv2', 'dbGaP'),
+                _variable_hit('HEAL:1', 'heal1', 'HEAL')]
+        result = self.search._make_result(None, hits, 3, False)
+        self.assertEqual(set(result), {'dbGaP', 'HEAL', 'total_items'})
+        self.assertEqual(len(result['dbGaP']), 1)
+        self.assertEqual([e['id'] for e in result['dbGaP'][0]['elements']],
+                         ['phv1', 'phv2'])
+
+        result = self.search._make_result('HEAL', hits, 3, False)
+        self.assertEqual(set(result), {'HEAL', 'total_items'})
+        self.assertEqual(result['total_items'], 3)
+
+    def test_variables_search_scores(self):
+        "Test that scored variable results include each hit's score"
+        es = mock.AsyncMock()
+        es.search.return_value = {'hits': {
+            'total': {'value': 2, 'relation': 'eq'},
+            'hits': [_variable_hit('phs000001', 'phv1', 'dbGaP', 12.3456789),
+                     _variable_hit('phs000001', 'phv2', 'dbGaP', 3.5)]}}
+        self.search.es = es
+        result = asyncio.run(self.search.search_variables(query="brain"))
+        elements = result['dbGaP'][0]['elements']
+        self.assertEqual([e['score'] for e in elements], [12.345679, 3.5])
+        self.assertEqual(es.search.call_args.kwargs['index'], 'variables_index')
+
+        asyncio.run(self.search.search_variables(query="brain",
+                                                 index="other_index"))
+        self.assertEqual(es.search.call_args.kwargs['index'], 'other_index')
+
+    def test_variables_data_type_filter(self):
+        "Test that the data type filter is sent to elasticsearch"
+        es = mock.AsyncMock()
+        es.search.return_value = {'hits': {
+            'total': {'value': 1, 'relation': 'eq'},
+            'hits': [_variable_hit('HEAL:1', 'heal1', 'HEAL')]}}
+        self.search.es = es
+        result = asyncio.run(self.search.search_variables(
+            query="brain", data_type="HEAL"))
+        self.assertEqual(set(result), {'HEAL', 'total_items'})
+        body = es.search.call_args.kwargs['body']
+        self.assertEqual(body['query']['bool']['filter'],
+                         [{'term': {'data_type.keyword': 'HEAL'}}])
+        cached = self.search._get_var_query("", 1, 3, "brain")
+        self.assertNotIn('filter', cached['query']['bool'])
+
+    def test_study_search_filters(self):
+        "Test that study IDs are exact filters and names are ranked"
+        es = mock.AsyncMock()
+        es.search.return_value = {'hits': {
+            'total': {'value': 0, 'relation': 'eq'}}}
+        self.search.es = es
+        result = asyncio.run(self.search.search_study(
+            study_id="phs000007.v30.p11", study_name="Framingham"))
+        self.assertEqual(result, {'total_items': 0})
+        query = es.search.call_args.kwargs['body']['query']
+        self.assertEqual(query['bool']['filter'], [
+            {'term': {'collection_id.keyword': 'phs000007.v30.p11'}}])
+        self.assertEqual(query['bool']['must'], [
+            {'match': {'collection_name': 'Framingham'}}])
+
+    def test_program_search_hits(self):
+        "Test that program search fetches hits unless asked not to"
+        es = mock.AsyncMock()
+        es.search.return_value = {'aggregations': {'unique_collection_ids': {
+            'buckets': [{'key': 'phs000001', 'doc_count': 3}]}}}
+        self.search.es = es
+        asyncio.run(self.search.search_program(program_name="dbGaP", size=10))
+        kwargs = es.search.call_args.kwargs
+        self.assertEqual(kwargs['size'], 10)
+        self.assertIn('hits.hits._source', kwargs['filter_path'])
+        self.assertIs(kwargs['track_total_hits'], False)
+
+        asyncio.run(self.search.search_program(program_name="dbGaP",
+                                               include_hits=False))
+        kwargs = es.search.call_args.kwargs
+        self.assertEqual(kwargs['size'], 0)
+        self.assertEqual(kwargs['filter_path'],
+                         ['aggregations.unique_collection_ids.buckets'])
+
+    def test_agg_data_type_cached(self):
+        "Test that data type aggregations are reused until they expire"
+        es = mock.AsyncMock()
+        es.search.return_value = {'aggregations': {'data_type': {
+            'buckets': [{'key': 'dbGaP', 'doc_count': 2}]}}}
+        self.search.es = es
+        self.assertEqual(asyncio.run(self.search.agg_data_type()), ['dbGaP'])
+        self.assertEqual(asyncio.run(self.search.agg_data_type()), ['dbGaP'])
+        self.assertEqual(es.search.await_count, 1)
+
+        expired = async_search.time.monotonic() - async_search._AGG_CACHE_TTL
+        self.search._agg_cache = (['dbGaP'], expired)
+        asyncio.run(self.search.agg_data_type())
+        self.assertEqual(es.search.await_count, 2)
+
+    def test_orjson_serializer(self):
+        "Test that the orjson serializer round-trips query bodies"
+        serializer = async_search.OrjsonSerializer()
+        encoded = serializer.dumps(self.query_body)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(serializer.loads(encoded), self.query_body)
+        self.assertEqual(serializer.dumps('{"a": 1}'), b'{"a": 1}')
+        self.assertIsNone(serializer.loads(b""))
+
+    def test_shared_client(self):
+        "Test that Search instances with the same config share one client"
+        first = async_search.Search(Config.from_env())
+        second = async_search.Search(Config.from_env())
+        self.assertIs(first.es, second.es)
+        other = async_search.Search(Config(elastic_host="elsewhere"))
+        self.assertIsNot(first.es, other.es)
+
+        asyncio.run(first.close())
+        third = async_search.Search(Config.from_env())
+        self.assertIsNot(third.es, first.es)
+
+    def test_dump_concepts_slices(self):
+        "Test that dump_concepts fans out one scan per slice and honors size"
+        scanned = []
+
+        async def _mock_scan(client, query, index, **kwargs):
+            scanned.append(query['slice'])
+            self.assertEqual(kwargs['size'], 7)
+            for i in range(5):
+                yield {'_id': f"{query['slice']['id']}-{i}"}
+
+        with mock.patch.object(async_search, 'async_scan', _mock_scan):
+            result = asyncio.run(self.search.dump_concepts(
+                'concepts_index', size=7, slices=3))
+        self.assertEqual(scanned, [{'id': i, 'max': 3} for i in range(3)])
+        self.assertEqual(len(result['result']['hits']['hits']), 7)
+
 
 brain_result_json = """{
   "hits": {
+    "total": {
+      "value": 90,
+      "relation": "eq"
+    },
     "hits": [
       {
         "_type": "_doc",
@@ -751,6 +972,23 @@ brain_result_json = """{
 }
 """
 
+def _variable_hit(collection_id, element_id, data_type, score=1.0):
+    "Minimal variables_index hit"
+    return {
+        "_id": element_id,
+        "_score": score,
+        "_source": {
+            "element_id": element_id,
+            "element_name": element_id,
+            "element_desc": f"description of {element_id}",
+            "element_action": "",
+            "collection_id": collection_id,
+            "collection_name": f"name of {collection_id}",
+            "collection_action": "",
+            "data_type": data_type,
+        }
+    }
+
 def _brain_search_result():
     """Stuck in a function just so I can shove it down here at the end
     of the test module"""